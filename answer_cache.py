@@ -0,0 +1,103 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+import faiss
+import numpy as np
+
+
+def normalize_question(question):
+    return " ".join(question.strip().lower().split())
+
+
+# Filler words that may differ between two phrasings of the same question
+STOP_WORDS = frozenset("""
+    a an the of in on at to for from by with about and or is are was were be
+    what whats which who whom how many much does do did can could would should
+    please tell me give show i you it its this that there
+""".split())
+
+
+def key_terms(question):
+    # Content words of a question; any difference (e.g. "canada" vs "croatia")
+    # means the questions ask about different things
+    return frozenset(re.findall(r"\w+", question.lower())) - STOP_WORDS
+
+
+class AnswerCache:
+    """Two-tier cache of agent answers.
+
+    Exact hits are looked up by normalized question text. On a miss, the
+    question embedding is compared against recent questions and an answer
+    is reused when the cosine similarity reaches ``similarity_threshold`` and
+    both questions have the same key terms, so templated questions about
+    different entities never share an answer. Entries expire after ``ttl``
+    seconds so answers refresh as documents change.
+    """
+
+    def __init__(self, dim, maxsize=2048, similarity_threshold=0.95, ttl=3600):
+        self._dim = dim
+        self._maxsize = maxsize
+        self._similarity_threshold = similarity_threshold
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # normalized question -> (embedding, answer, expires_at, key terms)
+            self._entries = OrderedDict()
+            self._questions = []
+            self._index = faiss.IndexFlatIP(self._dim)
+
+    def get_exact(self, question):
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_similar(self, question, embedding, candidates=4):
+        vector = self._as_vector(embedding)
+        terms = key_terms(question)
+        with self._lock:
+            if self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(vector, candidates)
+            for score, idx in zip(scores[0], ids[0]):
+                if idx < 0 or score < self._similarity_threshold:
+                    break
+                entry = self._entries.get(self._questions[idx])
+                if entry is None or entry[2] < time.monotonic() or entry[3] != terms:
+                    continue
+                return entry[1]
+            return None
+
+    def put(self, question, embedding, answer):
+        key = normalize_question(question)
+        vector = self._as_vector(embedding)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (vector, answer, time.monotonic() + self._ttl, key_terms(question))
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+            if key in self._questions or len(self._questions) >= 2 * self._maxsize:
+                self._rebuild_index()
+            else:
+                self._questions.append(key)
+                self._index.add(vector)
+
+    def _rebuild_index(self):
+        # Drop evicted and replaced questions from the similarity index
+        self._questions = list(self._entries)
+        self._index = faiss.IndexFlatIP(self._dim)
+        if self._questions:
+            self._index.add(np.vstack([entry[0] for entry in self._entries.values()]))
+
+    @staticmethod
+    def _as_vector(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
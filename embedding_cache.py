@@ -0,0 +1,108 @@
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+cache_file = "embedding_cache.sqlite3"
+
+# SQLite caps the number of bound parameters per statement
+_SELECT_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    def __init__(self, path=cache_file):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "hash BLOB PRIMARY KEY, provider TEXT, model TEXT, vec BLOB)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(text, provider, model):
+        return hashlib.sha256(
+            "\0".join([text, provider, model]).encode("utf-8")
+        ).digest()
+
+    def get_many(self, hashes):
+        found = {}
+        hashes = list(hashes)
+        with self._lock:
+            for start in range(0, len(hashes), _SELECT_BATCH_SIZE):
+                batch = hashes[start:start + _SELECT_BATCH_SIZE]
+                rows = self._conn.execute(
+                    "SELECT hash, vec FROM embeddings WHERE hash IN (%s)"
+                    % ",".join("?" * len(batch)),
+                    batch,
+                )
+                for digest, vec in rows:
+                    found[digest] = np.frombuffer(vec, dtype=np.float32)
+        return found
+
+    def put_many(self, vectors, provider, model):
+        rows = [
+            (digest, provider, model, np.asarray(vec, dtype=np.float32).tobytes())
+            for digest, vec in vectors.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, provider, model, vec) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+
+class CachedEmbedding(OpenAIEmbedding):
+    """OpenAI embeddings backed by an on-disk cache keyed by text and model.
+
+    Only text (chunk) embeddings are cached. Query embeddings, and questions
+    embedded with ``aget_uncached_text_embeddings``, go straight to the API:
+    they are rarely repeated, and caching them would add a blocking SQLite
+    write per request and grow the table without bound.
+    """
+
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, cache_path=cache_file, **kwargs):
+        super().__init__(**kwargs)
+        self._cache = EmbeddingCache(cache_path)
+
+    def _lookup(self, texts):
+        hashes = [EmbeddingCache.key(text, "openai", self.model_name) for text in texts]
+        cached = self._cache.get_many(set(hashes))
+        missing = {}
+        for digest, text in zip(hashes, texts):
+            if digest not in cached:
+                missing.setdefault(digest, text)
+        return hashes, cached, missing
+
+    def _store(self, hashes, cached, missing, fresh):
+        fresh = dict(zip(missing.keys(), fresh))
+        if fresh:
+            self._cache.put_many(fresh, "openai", self.model_name)
+            cached.update(fresh)
+        return [np.asarray(cached[digest], dtype=np.float32).tolist() for digest in hashes]
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        hashes, cached, missing = self._lookup(texts)
+        fresh = super()._get_text_embeddings(list(missing.values())) if missing else []
+        return self._store(hashes, cached, missing, fresh)
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aget_text_embeddings([text]))[0]
+
+    async def _aget_text_embeddings(self, texts):
+        hashes, cached, missing = self._lookup(texts)
+        fresh = await super()._aget_text_embeddings(list(missing.values())) if missing else []
+        return self._store(hashes, cached, missing, fresh)
+
+    async def aget_uncached_text_embeddings(self, texts):
+        return await super()._aget_text_embeddings(texts)
@@ -1,55 +1,50 @@
 from dotenv import load_dotenv
-import os
+from pathlib import Path
 import pandas as pd
-from llama_index.experimental.query_engine import PandasQueryEngine
+from concurrent.futures import ThreadPoolExecutor
+from pandas_cache import CachedPandasQueryEngine
 from prompts import new_prompt, instruction_str, context
-from note_engine import note_engine
-from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from tools import build_tools
 from llama_index.core.agent import ReActAgent
 from llama_index.llms.openai import OpenAI
 from pdf import pdf_engines
 
 load_dotenv()
 
+def read_csv(csv_path):
+    # Arrow's multithreaded parser, with Arrow-backed columns instead of Python objects
+    df = pd.read_csv(csv_path, engine='pyarrow', dtype_backend='pyarrow')
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif pd.api.types.is_string_dtype(df[col]) and len(df) and df[col].nunique() / len(df) < 0.5:
+            # Low-cardinality text columns are stored once per distinct value
+            df[col] = df[col].astype('category')
+    return df
+
+def load_csv(csv_path):
+    df = read_csv(csv_path)
+    query_engine = CachedPandasQueryEngine(df=df, verbose=True, instruction_str=instruction_str)
+    query_engine.update_prompts({"pandas_prompt": new_prompt})
+    return query_engine
+
 def load_csvs(csv_paths):
-    engines = {}
-    for csv_path in csv_paths:
-        csv_name = os.path.basename(csv_path).split('.')[0]
-        df = pd.read_csv(csv_path)
-        query_engine = PandasQueryEngine(df=df, verbose=True, instruction_str=instruction_str)
-        query_engine.update_prompts({"pandas_prompt": new_prompt})
-        engines[csv_name] = query_engine
-    return engines
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {executor.submit(load_csv, p): p for p in csv_paths}
+        return {
+            Path(csv_path).stem: future.result()
+            for future, csv_path in futures.items()
+        }
 
 # List of CSV files
-csv_paths = [os.path.join("data", "population.csv"), os.path.join("data", "movies.csv")]
+DATA_DIR = Path("data")
+csv_paths = [DATA_DIR / "population.csv", DATA_DIR / "movies.csv"]
 csv_engines = load_csvs(csv_paths)
 
-tools = [
-    note_engine,
-    *[
-        QueryEngineTool(
-            query_engine=engine,
-            metadata=ToolMetadata(
-                name=f"{name}_data",
-                description=f"This gives information about {name} data",
-            ),
-        )
-        for name, engine in csv_engines.items()
-    ],
-    *[
-        QueryEngineTool(
-            query_engine=engine.as_query_engine(),
-            metadata=ToolMetadata(
-                name=f"{name}_data",
-                description=f"This gives detailed information about {name} the document",
-            ),
-        )
-        for name, engine in pdf_engines.items()
-    ],
-]
-
-llm = OpenAI(model="gpt-3.5-turbo")
+tools = build_tools(csv_engines, pdf_engines)
+
+# gpt-4o-mini reuses cached prompt prefixes, so the ReAct header and tool list are billed and prefilled once
+llm = OpenAI(model="gpt-4o-mini")
 agent = ReActAgent.from_tools(tools, llm=llm, verbose=True, context=context)
 
 while (prompt := input("Enter a prompt (q to quit): ")) != "q":
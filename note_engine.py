@@ -1,14 +1,12 @@
 from llama_index.core.tools import FunctionTool
-import os
+from pathlib import Path
 
-note_file = os.path.join("data", "notes.txt")
+note_file = Path("data") / "notes.txt"
 
 
 def save_note(note):
-    if not os.path.exists(note_file):
-        open(note_file, "w")
-
-    with open(note_file, "a") as f:
+    # Append mode creates the file if it doesn't exist yet
+    with note_file.open("a") as f:
         f.writelines([note + "\n"])
 
     return "note saved"
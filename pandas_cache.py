@@ -0,0 +1,92 @@
+import hashlib
+import sqlite3
+import threading
+from llama_index.core.base.response.schema import Response
+from llama_index.core.utils import print_text
+from llama_index.experimental.query_engine import PandasQueryEngine
+
+cache_file = "pandas_cache.sqlite3"
+
+# Prefix of the output PandasInstructionParser returns when the code fails to run
+ERROR_OUTPUT_PREFIX = "There was an error running the output as Python code."
+
+
+class PandasCodeCache:
+    def __init__(self, path=cache_file):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pandas_code (hash BLOB PRIMARY KEY, code TEXT)"
+        )
+        self._conn.commit()
+
+    def get(self, digest):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT code FROM pandas_code WHERE hash = ?", (digest,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, digest, code):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pandas_code (hash, code) VALUES (?, ?)",
+                (digest, code),
+            )
+            self._conn.commit()
+
+
+class CachedPandasQueryEngine(PandasQueryEngine):
+    """PandasQueryEngine that reuses the pandas code generated for a repeated question.
+
+    The cache key covers the question, the dataframe schema and the prompt, so
+    a change to any of them generates fresh code. Code that failed to run is
+    not cached.
+    """
+
+    def __init__(self, *args, code_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._code_cache = code_cache or PandasCodeCache()
+
+    def _cache_key(self, query_str):
+        parts = [
+            query_str.strip(),
+            repr(tuple(self._df.columns)),
+            repr(tuple(self._df.dtypes.astype(str))),
+            self._pandas_prompt.get_template(),
+            self._instruction_str,
+        ]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).digest()
+
+    def _query(self, query_bundle):
+        key = self._cache_key(query_bundle.query_str)
+        pandas_response_str = self._code_cache.get(key)
+        if pandas_response_str is None:
+            response = super()._query(query_bundle)
+            if not str(response.metadata["raw_pandas_output"]).startswith(ERROR_OUTPUT_PREFIX):
+                self._code_cache.put(key, response.metadata["pandas_instruction_str"])
+            return response
+
+        if self._verbose:
+            print_text(f"> Cached Pandas Instructions:\n```\n{pandas_response_str}\n```\n")
+        pandas_output = self._instruction_parser.parse(pandas_response_str)
+        if self._verbose:
+            print_text(f"> Pandas Output: {pandas_output}\n")
+
+        response_metadata = {
+            "pandas_instruction_str": pandas_response_str,
+            "raw_pandas_output": pandas_output,
+        }
+        if self._synthesize_response:
+            response_str = str(
+                self._llm.predict(
+                    self._response_synthesis_prompt,
+                    query_str=query_bundle.query_str,
+                    pandas_instructions=pandas_response_str,
+                    pandas_output=pandas_output,
+                )
+            )
+        else:
+            response_str = str(pandas_output)
+        return Response(response=response_str, metadata=response_metadata)
@@ -1,30 +1,227 @@
 import os
+import logging
+import threading
+from pathlib import Path
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+from dotenv import load_dotenv
 from llama_index.core.storage import StorageContext
-from llama_index.core import VectorStoreIndex, load_index_from_storage
+from llama_index.core import Settings, VectorStoreIndex, load_index_from_storage
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
 from llama_index.readers.file import PDFReader
+from llama_index.vector_stores.faiss import FaissVectorStore
+from embedding_cache import CachedEmbedding
+from rerank import ConcurrentLLMRerank, RerankQueryEngine
 
+# OpenAI caps an embeddings request at 2048 inputs and 300k tokens in total;
+# 256 chunks of 512 tokens plus their embedded metadata stay well under both
+EMBED_BATCH_SIZE = 256
 
-def get_index(data, index_name):
-    index = None
-    if not os.path.exists(index_name):
-        print("Building index", index_name)
-        index = VectorStoreIndex.from_documents(data, show_progress=True)
-        index.storage_context.persist(persist_dir=index_name)
-    else:
-        index = load_index_from_storage(
-            StorageContext.from_defaults(persist_dir=index_name)
+# Dimension of text-embedding-ada-002 vectors and HNSW graph degree
+EMBED_DIM = 1536
+HNSW_M = 32
+
+MAX_LOAD_WORKERS = 8
+
+# Retrieval depth and synthesis mode shared by every PDF query engine
+QUERY_ENGINE_KWARGS = {"similarity_top_k": 2, "response_mode": "compact"}
+
+# Set RERANK_TOP_N to retrieve 4x as many chunks and keep the best N after an
+# LLM rerank; off by default since it adds an LLM call to every retrieval
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "0"))
+
+# Persisted indices live in STORAGE_DIR/<name>; build them ahead of time with
+# `python -m scripts.build_index`. With ENV=prod they are never built at startup.
+STORAGE_DIR = Path(os.getenv("STORAGE_DIR", "storage"))
+
+# The embedding model reads OPENAI_API_KEY when constructed at import time
+load_dotenv()
+Settings.embed_model = CachedEmbedding(embed_batch_size=EMBED_BATCH_SIZE)
+# Smaller sentence-aligned chunks with overlap keep each retrieved node on topic
+Settings.node_parser = SentenceSplitter(chunk_size=512, chunk_overlap=64, paragraph_separator="\n\n")
+
+
+def embed_nodes(nodes):
+    # One request per EMBED_BATCH_SIZE chunks instead of a request per chunk.
+    # Returns the ids of documents with a chunk that failed to embed.
+    failed_docs = set()
+    for start in range(0, len(nodes), EMBED_BATCH_SIZE):
+        batch = nodes[start:start + EMBED_BATCH_SIZE]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        try:
+            embeddings = Settings.embed_model.get_text_embedding_batch(texts)
+        except Exception as e:
+            logging.error(f"An error occurred while embedding chunks {start}-{start + len(batch)}: {str(e)}")
+            failed_docs.update(node.ref_doc_id for node in batch)
+            continue
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+    return failed_docs
+
+
+def new_vector_store():
+    # OpenAI embeddings are unit length, so inner product is cosine similarity.
+    # Vectors are stored as float16, halving index memory; fp16 needs no training.
+    faiss_index = faiss.IndexHNSWSQ(
+        EMBED_DIM, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    return FaissVectorStore(faiss_index=faiss_index)
+
+
+def index_dir(index_name, storage_dir=None):
+    return str(Path(storage_dir or STORAGE_DIR) / index_name)
+
+
+def index_exists(index_name, storage_dir=None):
+    return Path(index_dir(index_name, storage_dir)).exists()
+
+
+def build_indices(documents_by_name, storage_dir=None):
+    # Split and embed the documents of all indices together, then regroup
+    # the nodes by the index their source document belongs to
+    doc_names = {
+        doc.doc_id: name
+        for name, documents in documents_by_name.items()
+        for doc in documents
+    }
+    all_documents = [doc for documents in documents_by_name.values() for doc in documents]
+    nodes = Settings.node_parser.get_nodes_from_documents(all_documents, show_progress=True)
+    failed_names = {doc_names[doc_id] for doc_id in embed_nodes(nodes)}
+
+    nodes_by_name = {name: [] for name in documents_by_name if name not in failed_names}
+    for node in nodes:
+        if doc_names[node.ref_doc_id] in nodes_by_name:
+            nodes_by_name[doc_names[node.ref_doc_id]].append(node)
+    for name in sorted(failed_names):
+        logging.error(f"Skipping index {name}, some of its chunks could not be embedded")
+
+    # Build and persist each index on its own so one failure doesn't drop the rest
+    indices = {}
+    for name, index_nodes in nodes_by_name.items():
+        print("Building index", name)
+        try:
+            storage_context = StorageContext.from_defaults(vector_store=new_vector_store())
+            index = VectorStoreIndex(index_nodes, storage_context=storage_context)
+            index.storage_context.persist(persist_dir=index_dir(name, storage_dir))
+            indices[name] = index
+        except Exception as e:
+            logging.error(f"An error occurred while building index {name}: {str(e)}")
+    return indices
+
+
+def load_index(index_name, storage_dir=None):
+    persist_dir = index_dir(index_name, storage_dir)
+    vector_store = FaissVectorStore.from_persist_dir(persist_dir)
+    return load_index_from_storage(
+        StorageContext.from_defaults(vector_store=vector_store, persist_dir=persist_dir)
+    )
+
+
+# llm is the model that reranks; without it the reranker falls back to Settings.llm
+def as_query_engine(index, llm=None):
+    if RERANK_TOP_N:
+        return RerankQueryEngine.from_args(
+            index.as_retriever(similarity_top_k=4 * RERANK_TOP_N),
+            response_mode=QUERY_ENGINE_KWARGS["response_mode"],
+            node_postprocessors=[
+                ConcurrentLLMRerank(
+                    llm=llm, top_n=RERANK_TOP_N, choice_batch_size=RERANK_TOP_N, max_workers=8
+                )
+            ],
+        )
+    return index.as_query_engine(**QUERY_ENGINE_KWARGS)
+
+
+def pdf_name_of(pdf_path):
+    return Path(pdf_path).stem
+
+
+def _load_one_pdf(pdf_path):
+    # Returns a persisted index, or the parsed documents if it still needs building
+    pdf_name = pdf_name_of(pdf_path)
+    if index_exists(pdf_name):
+        return load_index(pdf_name), None
+    if os.getenv("ENV") == "prod":
+        raise FileNotFoundError(
+            f"No prebuilt index for {pdf_name} in {STORAGE_DIR}, run `python -m scripts.build_index`"
         )
-    return index
+    return None, PDFReader().load_data(file=pdf_path)
+
 
 def load_pdfs(pdf_paths):
     engines = {}
-    for pdf_path in pdf_paths:
-        pdf_name = os.path.basename(pdf_path).split('.')[0]
-        pdf_data = PDFReader().load_data(file=pdf_path)
-        engines[pdf_name] = get_index(pdf_data, pdf_name)
-    return engines
+    pending = {}
+    # Reading PDFs and loading persisted indices is I/O bound, so overlap it
+    with ThreadPoolExecutor(max_workers=MAX_LOAD_WORKERS) as executor:
+        futures = {executor.submit(_load_one_pdf, p): p for p in pdf_paths}
+        for future, pdf_path in futures.items():
+            index, documents = future.result()
+            if index is not None:
+                engines[pdf_name_of(pdf_path)] = index
+            else:
+                pending[pdf_name_of(pdf_path)] = documents
+    if pending:
+        engines.update(build_indices(pending))
+    # Build each query engine once here rather than whenever tools are assembled
+    return {name: as_query_engine(index) for name, index in engines.items()}
 
-# List of PDF files
-pdf_paths = [os.path.join("data", "Canada.pdf"), os.path.join("data", "Croatia.pdf")]
-pdf_engines = load_pdfs(pdf_paths)
 
+class LazyDict(Mapping):
+    """Read-only mapping whose values are loaded on first access and cached.
+
+    ``load_many`` receives ``{key: source}`` for every key not loaded yet and
+    returns ``{key: value}``; iterating values or items loads all of them at once.
+    Keys it leaves out of the result are remembered as failed: they are not
+    loaded again and no longer appear in iteration.
+    """
+
+    def __init__(self, sources, load_many):
+        self._sources = dict(sources)
+        self._load_many = load_many
+        self._values = {}
+        self._failed = set()
+        self._lock = threading.RLock()
+
+    def _load(self, keys):
+        with self._lock:
+            missing = {
+                k: self._sources[k] for k in keys
+                if k not in self._values and k not in self._failed
+            }
+            if missing:
+                self._values.update(self._load_many(missing))
+                self._failed.update(k for k in missing if k not in self._values)
+
+    def __getitem__(self, key):
+        if key not in self._sources:
+            raise KeyError(key)
+        self._load([key])
+        if key in self._failed:
+            raise KeyError(f"{key} failed to load, see the error logged when it was built")
+        return self._values[key]
+
+    def __iter__(self):
+        with self._lock:
+            return iter([k for k in self._sources if k not in self._failed])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sources) - len(self._failed)
+
+    def items(self):
+        self._load(self._sources)
+        return super().items()
+
+    def values(self):
+        self._load(self._sources)
+        return super().values()
+
+# List of PDF files
+DATA_DIR = Path("data")
+pdf_paths = [DATA_DIR / "Canada.pdf", DATA_DIR / "Croatia.pdf"]
+pdf_engines = LazyDict(
+    {pdf_name_of(p): p for p in pdf_paths},
+    lambda missing: load_pdfs(missing.values()),
+)
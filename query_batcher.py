@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+
+class QueryBatcher:
+    """Groups questions arriving within a short window and runs them together.
+
+    Flask runs each async view in its own event loop, so the queue lives on a
+    dedicated loop in a background thread. ``submit`` can be called from any
+    thread and returns a ``concurrent.futures.Future`` with the answer, set
+    as soon as that question's own run finishes. Identical questions are not
+    merged, since asking twice may mean saving a note twice. With
+    ``embed_fn``, the batch's questions are embedded in a single call and
+    ``query_fn`` receives ``(question, embedding)``.
+    """
+
+    def __init__(self, query_fn, embed_fn=None, batch_size=8, max_wait_ms=75, max_concurrency=16):
+        self._query_fn = query_fn
+        self._embed_fn = embed_fn
+        self._batch_size = batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._max_concurrency = max_concurrency
+        self._loop = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, question):
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._enqueue(question), self._loop)
+
+    def _ensure_started(self):
+        # Started lazily so the thread is created in the process that serves requests
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self._loop = loop
+
+    async def _setup(self):
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        # The loop only keeps weak references to tasks, so hold on to them here
+        self._tasks = set()
+        self._spawn(self._drain())
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _enqueue(self, question):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((question, future))
+        return await future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        questions = [question for question, _ in batch]
+        if self._embed_fn is not None:
+            try:
+                embeddings = await self._embed_fn(questions)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            args = [(q, emb) for q, emb in zip(questions, embeddings)]
+        else:
+            args = [(q,) for q in questions]
+        await asyncio.gather(
+            *(self._run_one(future, *a) for (_, future), a in zip(batch, args))
+        )
+
+    async def _run_one(self, future, *args):
+        # Answer this caller right away rather than after the whole batch
+        try:
+            async with self._semaphore:
+                result = await self._query_fn(*args)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import NodeWithScore
+
+# Relevance given to nodes whose batch could not be scored, the middle of
+# LLMRerank's 1-10 scale so they still compete with the scored nodes
+FALLBACK_SCORE = 5.0
+
+
+class ConcurrentLLMRerank(LLMRerank):
+    """LLMRerank that scores its node batches in parallel.
+
+    Each batch of ``choice_batch_size`` nodes is ranked by ``LLMRerank`` itself
+    with a single prompt, but the batches no longer wait on each other. A
+    batch whose LLM call fails, or whose answer can't be parsed, keeps its
+    nodes with ``FALLBACK_SCORE`` instead of failing the query.
+    """
+
+    max_workers: int = Field(default=8, description="Maximum concurrent rerank calls.")
+
+    def __init__(self, *args, max_workers=8, **kwargs):
+        # LLMRerank.__init__ only accepts its own arguments
+        super().__init__(*args, **kwargs)
+        self.max_workers = max_workers
+
+    def _rerank_batch(self, batch, query_bundle):
+        # The batch fits in one prompt, so the parent ranks it with a single LLM
+        # call and emits its usual reranking events
+        return super()._postprocess_nodes(batch, query_bundle)
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if query_bundle is None:
+            raise ValueError("Query bundle must be provided.")
+        if len(nodes) == 0:
+            return []
+
+        batches = [
+            nodes[idx : idx + self.choice_batch_size]
+            for idx in range(0, len(nodes), self.choice_batch_size)
+        ]
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._rerank_batch, batch, query_bundle): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    logging.error(f"Rerank batch failed, using fallback scores: {str(e)}")
+                    results.extend(
+                        NodeWithScore(node=node.node, score=FALLBACK_SCORE)
+                        for node in futures[future]
+                    )
+        # Each batch already kept its top_n, so the overall top_n is among them
+        return sorted(results, key=lambda x: x.score or 0.0, reverse=True)[: self.top_n]
+
+
+class RerankQueryEngine(RetrieverQueryEngine):
+    """RetrieverQueryEngine that runs its node postprocessors in a thread on async queries.
+
+    The base class applies them synchronously inside ``aretrieve``, so an LLM
+    rerank would block the event loop every other query is waiting on.
+    """
+
+    async def aretrieve(self, query_bundle):
+        nodes = await self._retriever.aretrieve(query_bundle)
+        return await asyncio.to_thread(
+            self._apply_node_postprocessors, nodes, query_bundle=query_bundle
+        )
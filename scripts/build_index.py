@@ -0,0 +1,48 @@
+import argparse
+from pathlib import Path
+import pdf
+from llama_index.readers.file import PDFReader
+
+
+def build_local(data_dir, storage_dir):
+    pending = {}
+    for pdf_path in sorted(Path(data_dir).glob("*.pdf")):
+        pdf_name = pdf.pdf_name_of(pdf_path)
+        if pdf.index_exists(pdf_name, storage_dir):
+            print("Index already built", pdf_name)
+            continue
+        pending[pdf_name] = PDFReader().load_data(file=pdf_path)
+
+    if pending:
+        pdf.build_indices(pending, storage_dir)
+
+
+def build_gridfs(storage_dir):
+    # Imported here so local-only builds don't need MongoDB credentials
+    import server
+
+    records = [
+        record for record in server.pdf_collection.find({"type": "pdf"}, {"filename": 1, "file_id": 1})
+        if not pdf.index_exists(server.index_name_of(record), storage_dir)
+    ]
+    # Record status is left alone: running servers load an index once it is
+    # "ready", and these indices only exist on this machine until deployed
+    documents = server.fetch_pdf_documents(records)
+    if documents:
+        pdf.build_indices(documents, storage_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed the PDFs and persist their indices ahead of deployment")
+    parser.add_argument("--data", default="data", help="directory containing the PDF files")
+    parser.add_argument("--out", default=str(pdf.STORAGE_DIR), help="directory to persist the indices to")
+    parser.add_argument("--gridfs", action="store_true", help="also build the PDFs uploaded to MongoDB GridFS")
+    args = parser.parse_args()
+
+    build_local(args.data, args.out)
+    if args.gridfs:
+        build_gridfs(args.out)
+
+
+if __name__ == "__main__":
+    main()
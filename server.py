@@ -7,18 +7,29 @@ import os
 import gridfs
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
-from io import BytesIO
+from bson import ObjectId
+from bson.errors import InvalidId
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.experimental.query_engine import PandasQueryEngine
 from prompts import new_prompt, instruction_str, context
+from tools import build_tools
 from note_engine import note_engine
-from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.core.agent import ReActAgent
 from llama_index.llms.openai import OpenAI
-from pdf import get_index, PDFReader
+from llama_index.core import Document, Settings
+from werkzeug.utils import secure_filename
+from pdf import EMBED_DIM, MAX_LOAD_WORKERS, as_query_engine, build_indices, index_exists, load_index, pdf_name_of
+from answer_cache import AnswerCache
+from query_batcher import QueryBatcher
 import logging
+import functools
+import time
 import datetime
-import PyPDF2  # Added for PDF parsing
+import threading
+import asyncio
+import pypdfium2 as pdfium
 
 # Initialize logging
 logging.basicConfig(level=logging.DEBUG)
@@ -28,7 +39,8 @@ load_dotenv()
 
 # MongoDB Atlas Configuration
 uri = "mongodb+srv://test:" + os.getenv('MONGO_PASSWORD') + "@clustertest.kimvepl.mongodb.net/?retryWrites=true&w=majority&appName=ClusterTest"
-client = MongoClient(uri, server_api=ServerApi('1'))
+# Pooled connections with wire compression (zstd needs the zstandard package, zlib is the fallback)
+client = MongoClient(uri, server_api=ServerApi('1'), maxPoolSize=50, compressors='zstd,zlib')
 
 # Connect to your database
 db = client['AI']
@@ -56,67 +68,262 @@ try:
 except Exception as e:
     print(e)
 
-# Function to extract text from a PDF using PyPDF2
+# PDFium is not thread-safe, so extraction is serialized
+pdfium_lock = threading.Lock()
+
+# Function to extract text from a PDF using pypdfium2
 def extract_text_from_pdf(pdf_bytes):
     try:
-        reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
-        text = ""
-        for page in range(len(reader.pages)):
-            text += reader.pages[page].extract_text()
-        return text
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return "\n".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
     except Exception as e:
         logging.error(f"Error extracting text from PDF: {str(e)}")
         return ""
 
-# Load PDFs from GridFS and create query engines
-def load_pdfs_from_gridfs(pdf_ids):
-    engines = {}
-    for pdf_id in pdf_ids:
-        result = pdf_collection.find_one({"_id": pdf_id})
-        if result is None:
-            logging.error(f"No document found with _id {pdf_id}")
-            continue
+# Wrap the text of an in-memory PDF in documents ready for indexing
+def pdf_documents(file_name, pdf_bytes):
+    pdf_text = extract_text_from_pdf(pdf_bytes)
+    return [Document(text=pdf_text, metadata={"file_name": file_name})]
+
+# Index directory of a PDF record. secure_filename can map different uploads to
+# the same stem (non-ASCII names all become "pdf"), so the record id keeps it unique
+def index_name_of(record):
+    return f"{pdf_name_of(record['filename'])}_{record['_id']}"
+
+# Key the engines by the file stem the LLM sees in tool names and descriptions,
+# numbering uploads that share a stem in upload (ObjectId) order
+def tool_engines_of(engines):
+    tool_engines = {}
+    for index_name in sorted(engines, key=lambda name: name.rsplit("_", 1)[1]):
+        stem = index_name.rsplit("_", 1)[0]
+        name, n = stem, 1
+        while name in tool_engines:
+            n += 1
+            name = f"{stem}_{n}"
+        tool_engines[name] = engines[index_name]
+    return tool_engines
+
+# Load a persisted index as a query engine; unreadable indices are logged and skipped
+def load_pdf_engine(pdf_name):
+    try:
+        return as_query_engine(load_index(pdf_name), get_llm())
+    except Exception as e:
+        logging.error(f"An error occurred while loading the index for {pdf_name}: {str(e)}")
+        return None
 
-        file_name = result['filename']
-        pdf_name = os.path.splitext(file_name)[0]
+# Load the persisted indices of the given PDF records as query engines
+def load_pdf_engines(records):
+    names = [index_name_of(record) for record in records]
+    engines = {}
+    # Persisted index loads are I/O bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=MAX_LOAD_WORKERS) as executor:
+        for pdf_name, engine in zip(names, executor.map(load_pdf_engine, names)):
+            if engine is not None:
+                engines[pdf_name] = engine
+    return engines
 
-        # Check if the file exists in GridFS
-        if not fs.exists(pdf_id):
-            logging.error(f"File with _id {pdf_id} does not exist in GridFS")
+# Fetch the given PDF records from GridFS as documents keyed by index name
+def fetch_pdf_documents(records):
+    records_by_file = {record['file_id']: record for record in records}
+    # Stream the GridFS chunks of every PDF with one cursor, ordered by file
+    # and chunk number, instead of a get() per file
+    chunks = {file_id: [] for file_id in records_by_file}
+    if chunks:
+        cursor = db['fs.chunks'].find(
+            {"files_id": {"$in": list(chunks)}}, {"files_id": 1, "data": 1}
+        ).sort([("files_id", 1), ("n", 1)])
+        for chunk in cursor:
+            chunks[chunk['files_id']].append(chunk['data'])
+
+    documents = {}
+    for file_id, result in records_by_file.items():
+        if not chunks[file_id]:
+            logging.error(f"File with _id {file_id} does not exist in GridFS")
             continue
-
         try:
-            pdf_bytes = fs.get(pdf_id).read()
-            pdf_text = extract_text_from_pdf(pdf_bytes)
-            index = get_index([pdf_text], pdf_name)  # Assuming the get_index function builds an index from the content
-            engines[pdf_name] = index.as_query_engine()
+            documents[index_name_of(result)] = pdf_documents(result['filename'], b"".join(chunks[file_id]))
         except Exception as e:
-            logging.error(f"An error occurred while processing PDF with _id {pdf_id}: {str(e)}")
-    return engines
-
-# Initialize data and query engines with existing files
-pdf_files = list(pdf_collection.find({"type": "pdf"}))
-pdf_ids = [file['_id'] for file in pdf_files]
-
-pdf_engines = load_pdfs_from_gridfs(pdf_ids)
-
-tools = [
-    note_engine,
-    *[
-        QueryEngineTool(
-            query_engine=engine,
-            metadata=ToolMetadata(
-                name=f"{name}_data",
-                description=f"This gives detailed information about {name} the document",
-            ),
+            logging.error(f"An error occurred while processing PDF with _id {result['_id']}: {str(e)}")
+    return documents
+
+# Build and persist the indices of claimed PDF records, then publish their status.
+# Setting "ready" is what makes every process load the new index, see handle_pdf_change.
+def index_pdfs(records):
+    if not records:
+        return
+    built = {index_name_of(record) for record in records if index_exists(index_name_of(record))}
+    documents = fetch_pdf_documents([record for record in records if index_name_of(record) not in built])
+    # Embed all new PDFs together so chunks share batched embedding requests;
+    # build_indices skips any single index that fails to embed, build or persist
+    if documents:
+        try:
+            built.update(build_indices(documents))
+        except Exception as e:
+            logging.error(f"An error occurred while embedding PDFs {list(documents)}: {str(e)}")
+    for record in records:
+        status = "ready" if index_name_of(record) in built else "failed"
+        pdf_collection.update_one({"_id": record['_id']}, {"$set": {"status": status}})
+
+# An indexing claim older than this is assumed abandoned by a process that died
+CLAIM_TIMEOUT = datetime.timedelta(minutes=30)
+
+def claimable_filter():
+    stale = datetime.datetime.now(datetime.timezone.utc) - CLAIM_TIMEOUT
+    return {"$or": [
+        # Records from before background ingestion have no status
+        {"status": {"$in": ["pending", None]}},
+        {"status": "indexing", "claimed_at": {"$lt": stale}},
+    ]}
+
+# Atomically claim matching PDF records for indexing, so each one is built by a single process
+def claim_pdfs(match):
+    claimed = []
+    for record in pdf_collection.find({**match, **claimable_filter()}, {"_id": 1}):
+        result = pdf_collection.find_one_and_update(
+            {"_id": record['_id'], **claimable_filter()},
+            {"$set": {"status": "indexing", "claimed_at": datetime.datetime.now(datetime.timezone.utc)}},
+            projection={"filename": 1, "file_id": 1},
+            return_document=ReturnDocument.AFTER,
         )
-        for name, engine in pdf_engines.items()
-    ],
-]
+        if result is not None:
+            claimed.append(result)
+    return claimed
+
+# Query engines for the stored files, loaded on first use rather than at import.
+# The upload watcher adds to it, so access goes through pdf_engines_lock.
+pdf_engines = None
+pdf_engines_lock = threading.RLock()
+
+def get_pdf_engines():
+    global pdf_engines
+    with pdf_engines_lock:
+        if pdf_engines is None:
+            if os.getenv("ENV") != "prod":
+                # Index stored PDFs no process has claimed yet, then load every finished index
+                index_pdfs(claim_pdfs({"type": "pdf"}))
+                records = list(pdf_collection.find({"type": "pdf", "status": "ready"}, {"filename": 1}))
+            else:
+                # Nothing is embedded at startup in prod. Indices prebuilt with
+                # `python -m scripts.build_index --gridfs` don't change the record status.
+                records = [
+                    record for record in pdf_collection.find({"type": "pdf"}, {"filename": 1})
+                    if index_exists(index_name_of(record))
+                ]
+            pdf_engines = load_pdf_engines(records)
+        return pdf_engines
+
+# Load a PDF whose index has just been finished and swap its engine in
+def add_ready_pdf(pdf_id):
+    record = pdf_collection.find_one({"_id": pdf_id}, {"filename": 1})
+    if record is None:
+        return
+    with pdf_engines_lock:
+        if index_name_of(record) in get_pdf_engines():
+            return
+    engines = load_pdf_engines([record])
+    if not engines:
+        return
+    with pdf_engines_lock:
+        get_pdf_engines().update(engines)
+    # Rebuild the agent on the next question so it gets tools for the new file
+    get_tools.cache_clear()
+    # New documents may change earlier answers
+    answer_cache.clear()
+
+# Every serving process watches the collection: the process that claims an inserted
+# record builds its index, and all of them load it once its status becomes "ready"
+UPLOAD_PIPELINE = [{'$match': {'$or': [
+    {'operationType': 'insert'},
+    {'operationType': 'update', 'updateDescription.updatedFields.status': 'ready'},
+]}}]
+
+def handle_pdf_change(change):
+    pdf_id = change['documentKey']['_id']
+    if change['operationType'] == 'insert':
+        index_pdfs(claim_pdfs({"_id": pdf_id}))
+    else:
+        add_ready_pdf(pdf_id)
 
-# Initialize LLM and agent
-llm = OpenAI(model="gpt-3.5-turbo")
-agent = ReActAgent.from_tools(tools, llm=llm, verbose=True, context=context)
+# Ingest PDFs as their records are inserted, resuming the change stream after errors
+def watch_pdf_uploads(stream):
+    resume_token = None
+    while True:
+        try:
+            get_pdf_engines()
+            if stream is None:
+                stream = pdf_collection.watch(UPLOAD_PIPELINE, resume_after=resume_token)
+            with stream:
+                for change in stream:
+                    try:
+                        handle_pdf_change(change)
+                    except Exception as e:
+                        logging.error(f"Error handling PDF change {change['documentKey']}: {str(e)}", exc_info=True)
+        except Exception as e:
+            # Any failure, not just Mongo errors, must not end the thread for good
+            logging.error(f"PDF change stream failed, reopening: {str(e)}", exc_info=True)
+            time.sleep(1)
+        if stream is not None:
+            resume_token = stream.resume_token or resume_token
+            stream.close()
+        stream = None
+
+upload_watcher = None
+upload_watcher_lock = threading.Lock()
+
+# Start the background ingestion thread once per process, or again if it died
+def start_upload_watcher():
+    global upload_watcher
+    with upload_watcher_lock:
+        if upload_watcher is None or not upload_watcher.is_alive():
+            # Open the stream before the initial load so no insert in between is missed
+            stream = pdf_collection.watch(UPLOAD_PIPELINE)
+            upload_watcher = threading.Thread(target=watch_pdf_uploads, args=(stream,), daemon=True)
+            upload_watcher.start()
+
+# Initialize the agent's tools on first use; cleared when the set of PDFs changes
+@functools.lru_cache(maxsize=1)
+def get_tools():
+    start_upload_watcher()
+    with pdf_engines_lock:
+        engines = tool_engines_of(get_pdf_engines())
+    return build_tools({}, engines)
+
+# Initialize LLM on first use
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    # gpt-4o-mini reuses cached prompt prefixes, so the ReAct header and tool list are billed and prefilled once
+    return OpenAI(model="gpt-4o-mini")
+
+# Queries run concurrently, so each gets its own agent and chat memory;
+# the tools and LLM they wrap are shared
+def new_agent():
+    return ReActAgent.from_tools(get_tools(), llm=get_llm(), verbose=True, context=context)
+
+# Cache of answers for repeated and near-identical questions
+answer_cache = AnswerCache(EMBED_DIM)
+# Tools whose calls must run every time, so their answers are never cached
+SIDE_EFFECT_TOOLS = {note_engine.metadata.name}
+
+# Answer a question missing from the exact cache, given its embedding
+async def answer_question(question, embedding):
+    answer = answer_cache.get_similar(question, embedding)
+    if answer is None:
+        # Building the tools can load and embed every PDF, so keep it off the batcher's loop
+        agent = await asyncio.to_thread(new_agent)
+        response = await agent.achat(question)
+        answer = str(response)  # Ensure result is converted to string
+        # Answers from side-effecting tools (saving a note) must not be replayed
+        if not any(source.tool_name in SIDE_EFFECT_TOOLS for source in response.sources):
+            answer_cache.put(question, embedding, answer)
+    return answer
+
+# Agent calls arriving close together are dispatched as one concurrent batch.
+# The batch's questions are embedded in one request for the semantic answer cache.
+query_batcher = QueryBatcher(answer_question, embed_fn=Settings.embed_model.aget_uncached_text_embeddings)
 
 # Flask routes
 
@@ -165,42 +372,69 @@ def login():
     else:
         return jsonify({'error': 'Invalid credentials'}), 401
 
-# Ask AI route
+# Ask AI route (async views need flask[async]). Under WSGI the worker thread stays blocked
+# until the answer is ready, so concurrent requests need gunicorn --threads; awaiting only
+# lets the agent calls run on the batcher's event loop.
 @app.route('/api/ask_ai', methods=['POST'])
-def ask_ai():
+async def ask_ai():
     data = request.get_json()
     question = data.get('question')
     if not question:
         return jsonify({'error': 'Question is required'}), 400
     try:
-        result = agent.query(question)
-        return jsonify({'answer': str(result)})  # Ensure result is converted to string
+        answer = answer_cache.get_exact(question)
+        if answer is None:
+            answer = await asyncio.wrap_future(query_batcher.submit(question))
+        return jsonify({'answer': answer})
     except Exception as e:
         logging.error(f"Error processing the request: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
-# Upload files route
+# Upload files route; indexing happens in the background, see watch_pdf_uploads
 @app.route('/api/upload_files', methods=['POST'])
 def upload_files():
     if 'files' not in request.files:
         return jsonify({'error': 'No files part in the request'}), 400
 
+    # Make sure this process is watching before the records are inserted
+    start_upload_watcher()
+
     files = request.files.getlist('files')
+    job_ids = []
     for file in files:
         if file:
-            file_id = fs.put(file, filename=file.filename)
+            # The name becomes an index directory, so strip any path components
+            file_name = secure_filename(file.filename)
+            if not file_name:
+                logging.error(f"Skipping upload with unusable file name {file.filename!r}")
+                continue
+            file_id = fs.put(file.stream, filename=file_name)
             # Store file metadata in MongoDB
             file_metadata = {
-                "filename": file.filename,
+                "filename": file_name,
                 "file_id": file_id,
-                "type": "pdf"  # Assuming we are handling only PDFs for this task
+                "type": "pdf",  # Assuming we are handling only PDFs for this task
+                "status": "pending"
             }
-            pdf_collection.insert_one(file_metadata)
+            job_ids.append(str(pdf_collection.insert_one(file_metadata).inserted_id))
 
-            # Update engines with the new file content
-            pdf_engines.update(load_pdfs_from_gridfs([file_id]))
-
-    return jsonify({'message': 'Files uploaded successfully'}), 200
+    return jsonify({'message': 'Files accepted for processing', 'job_ids': job_ids}), 202
 
+# Upload status route
+@app.route('/api/upload_files/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    try:
+        result = pdf_collection.find_one({'_id': ObjectId(job_id)}, {'filename': 1, 'status': 1})
+    except InvalidId:
+        return jsonify({'error': 'Invalid job id'}), 400
+    if result is None:
+        return jsonify({'error': 'Job not found'}), 404
+    # Records from before background ingestion have no status until a process claims them
+    return jsonify({'filename': result['filename'], 'status': result.get('status', 'pending')}), 200
+
+# Development server only. In production run under gunicorn so several LLM requests overlap:
+#   gunicorn --workers $(nproc) --threads 16 server:app
+# Don't use --preload: the Mongo client, the embedding cache's SQLite connection and the
+# background threads are per-process and must not be inherited across fork().
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
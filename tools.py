@@ -0,0 +1,30 @@
+from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from note_engine import note_engine
+
+
+def build_tools(csv_engines, pdf_engines):
+    # Tool descriptions form the ReAct system prompt; a fixed order keeps that
+    # prefix identical across processes and restarts so provider prompt caching hits
+    return [
+        note_engine,
+        *[
+            QueryEngineTool(
+                query_engine=engine,
+                metadata=ToolMetadata(
+                    name=f"{name}_data",
+                    description=f"This gives information about {name} data",
+                ),
+            )
+            for name, engine in sorted(csv_engines.items())
+        ],
+        *[
+            QueryEngineTool(
+                query_engine=engine,
+                metadata=ToolMetadata(
+                    name=f"{name}_data",
+                    description=f"This gives detailed information about {name} the document",
+                ),
+            )
+            for name, engine in sorted(pdf_engines.items())
+        ],
+    ]